@@ -10,7 +10,12 @@ if [[ -n "$4" ]]; then
     LABELS="--labels ${4}"
 fi
 
-tar zxf actions-runner.tar.gz
+# When the runner is shared into the VM instead of being copied over ssh, the
+# tarball sits next to this script and still needs unpacking.
+SHARED_TARBALL="$(dirname "$0")/actions-runner.tar.gz"
+if [[ -f "$SHARED_TARBALL" ]]; then
+    tar zxf "$SHARED_TARBALL"
+fi
 
 sudo scutil --set HostName $NAME
 sudo scutil --set ComputerName $NAME
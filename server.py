@@ -1,22 +1,81 @@
-import binascii
-import codecs
 import datetime
+import multiprocessing
 import os
+import random
+import secrets
+import shlex
 import signal
 import subprocess
 import sys
-import textwrap
 import time
 import typing
 from functools import partial
 
 import httpx
 import jwt
+import orjson
 import toml
 import trio
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
 
 BASE_DIR = os.path.dirname(__file__)
 
+# Arguments shared by every ssh invocation against a runner VM.
+SSH_OPTS = (
+    "-i",
+    "./id_rsa",
+    "-o",
+    "StrictHostKeyChecking=no",
+    "-o",
+    "UserKnownHostsFile=/dev/null",
+)
+# Added for the connection that becomes the control master, see ssh_control_path.
+SSH_MASTER_OPTS = (
+    "-o",
+    "ControlMaster=auto",
+    "-o",
+    "ControlPersist=60s",
+)
+LAUNCH_COMMAND = "{launcher} {token} {runner_name} https://github.com/{org} {labels}"
+
+# With share_runner_files enabled, this directory is shared read-only with every
+# VM instead of copying the runner over ssh. It only ever holds links to the
+# runner tarball and launcher; the rest of BASE_DIR includes private keys that
+# jobs running in the VM must not be able to read.
+SHARED_DIR = os.path.join(BASE_DIR, "shared")
+# Where tart mounts the directory shared as "cidermill" inside a macOS VM.
+GUEST_SHARED_DIR = "/Volumes/My Shared Files/cidermill"
+# The share is mounted when the VM's user session starts, which can be a little
+# after sshd is reachable, so give it a few seconds to appear.
+SHARED_LAUNCHER = (
+    f"for _ in $(seq 30); do [ -d {shlex.quote(GUEST_SHARED_DIR)} ] && break; "
+    f"sleep 1; done; {shlex.quote(GUEST_SHARED_DIR + '/runner-launcher.sh')}"
+)
+
+# Upper bound, in seconds, on the backoff between runner restarts.
+MAX_RETRY_DELAY = 300
+
+# Refresh cached GitHub tokens once they are this close to expiring.
+TOKEN_EXPIRY_SKEW = datetime.timedelta(seconds=60)
+# The registration token is only consumed by config.sh once the VM has booted
+# and the runner has been copied over, so it needs a much wider margin.
+REGISTRATION_TOKEN_EXPIRY_SKEW = datetime.timedelta(minutes=10)
+
+# Tokens handed out by GitHub, keyed by installation id and then by token kind
+# ("installation_token" or "registration_token"). Each value is a
+# (token, expires_at) tuple. Guarded by _token_lock so that runners starting at
+# the same time share a single refresh.
+_token_cache: typing.Dict[
+    str, typing.Dict[str, typing.Tuple[str, datetime.datetime]]
+] = {}
+_token_lock = trio.Lock()
+
+# Set once startup_checks has passed in this process.
+_checked = False
+
+# The most recently signed app JWT and its expiry as a unix timestamp.
+_jwt_cache: typing.Dict[str, typing.Any] = {"token": None, "exp": 0}
+
 try:
     with open(os.path.join(BASE_DIR, ".path"), "r") as f:
         os.environ["PATH"] = f.read().strip()
@@ -27,11 +86,17 @@ except FileNotFoundError:
 def load_config() -> typing.Dict:
     config = toml.load(os.path.join(BASE_DIR, "config.toml"))["config"]
     with open(os.path.join(BASE_DIR, config["private_key_path"]), "rb") as f:
-        signing_key = jwt.jwk_from_pem(f.read())
+        signing_key = load_pem_private_key(f.read(), password=None)
 
     config["signing_key"] = signing_key
     if config.get("labels", None) is None:
         config["labels"] = ""
+    if config.get("pool_size", None) is None:
+        config["pool_size"] = 1
+    if config.get("share_runner_files", None) is None:
+        config["share_runner_files"] = False
+    if config.get("workers", None) is None:
+        config["workers"] = 1
     return config
 
 
@@ -40,34 +105,77 @@ def log(data):
 
 
 async def generate_jwt(config: typing.Dict) -> str:
-    instance = jwt.JWT()
+    now = int(time.time())
+    # Signing is pure CPU on the trio thread, so reuse the JWT until it's
+    # about to expire.
+    if _jwt_cache["exp"] - now > TOKEN_EXPIRY_SKEW.total_seconds():
+        return _jwt_cache["token"]
     payload = {
         # Issued at time
-        "iat": int(time.time()) - 30,
+        "iat": now - 30,
         # JWT expiration time (10 minutes maximum)
-        "exp": int(time.time()) + 600,
+        "exp": now + 600,
         # GitHub App's identifier
         "iss": config["app_id"],
     }
-    encoded_jwt = instance.encode(payload, config["signing_key"], alg="RS256")
+    encoded_jwt = jwt.encode(payload, config["signing_key"], algorithm="RS256")
+    _jwt_cache["token"] = encoded_jwt
+    _jwt_cache["exp"] = payload["exp"]
     return encoded_jwt
 
 
-async def get_registration_token(config: typing.Dict) -> str:
-    log("Requesting new runner registration-token to github ...")
+def parse_github_timestamp(value: str) -> datetime.datetime:
+    # fromisoformat only understands a trailing "Z" from Python 3.11 onwards.
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def get_cached_token(
+    config: typing.Dict, kind: str, skew: datetime.timedelta = TOKEN_EXPIRY_SKEW
+) -> typing.Optional[str]:
+    entry = _token_cache.get(str(config["installation_id"]), {}).get(kind)
+    if entry is None:
+        return None
+    token, expires_at = entry
+    if expires_at - datetime.datetime.now(datetime.timezone.utc) < skew:
+        return None
+    return token
+
+
+def cache_token(config: typing.Dict, kind: str, response_data: typing.Dict) -> None:
+    _token_cache.setdefault(str(config["installation_id"]), {})[kind] = (
+        response_data["token"],
+        parse_github_timestamp(response_data["expires_at"]),
+    )
+
+
+async def get_installation_token(config: typing.Dict) -> str:
+    token = get_cached_token(config, "installation_token")
+    if token is not None:
+        return token
     app_token = await generate_jwt(config)
-    transport = httpx.AsyncHTTPTransport(retries=1500)
-    async with httpx.AsyncClient(transport=transport) as client:
-        res = await client.post(
-            f"https://api.github.com/app/installations/{config['installation_id']}/access_tokens",
-            headers={
-                "Accept": "application/vnd.github.v3+json",
-                "Authorization": f"Bearer {app_token}",
-            },
+    res = await config["http_client"].post(
+        f"https://api.github.com/app/installations/{config['installation_id']}/access_tokens",
+        headers={
+            "Accept": "application/vnd.github.v3+json",
+            "Authorization": f"Bearer {app_token}",
+        },
+    )
+    response_data = orjson.loads(res.content)
+    cache_token(config, "installation_token", response_data)
+    return response_data["token"]
+
+
+async def get_registration_token(config: typing.Dict) -> str:
+    async with _token_lock:
+        token = get_cached_token(
+            config, "registration_token", REGISTRATION_TOKEN_EXPIRY_SKEW
         )
-        response_data = res.json()
-        endpoint_token = response_data["token"]
-        res = await client.post(
+        if token is not None:
+            log("Reusing cached runner registration-token")
+            return token
+        log("Requesting new runner registration-token to github ...")
+        endpoint_token = await get_installation_token(config)
+        res = await config["http_client"].post(
             f"https://api.github.com/orgs/"
             f"{config['org']}/actions/runners/registration-token",
             headers={
@@ -75,7 +183,8 @@ async def get_registration_token(config: typing.Dict) -> str:
                 "Authorization": f"Bearer {endpoint_token}",
             },
         )
-        response_data = res.json()
+        response_data = orjson.loads(res.content)
+        cache_token(config, "registration_token", response_data)
     log(
         f"New registration token is {response_data['token']} and "
         f"expires at {response_data['expires_at']}"
@@ -83,54 +192,112 @@ async def get_registration_token(config: typing.Dict) -> str:
     return response_data["token"]
 
 
+# trio.run_process opens a nursery for every call, which buys nothing for tart
+# commands that don't need any of their I/O piped. This spawns the process with
+# its output going straight to our logs and just waits for it.
+async def run_command(command: typing.List[str], check: bool = True) -> int:
+    process = await trio.lowlevel.open_process(command, stdin=subprocess.DEVNULL)
+    try:
+        returncode = await process.wait()
+    finally:
+        if process.returncode is None:
+            # Same as trio.run_process: give the command a chance to clean up
+            # after itself before falling back to SIGKILL.
+            with trio.CancelScope(shield=True):
+                process.terminate()
+                with trio.move_on_after(5):
+                    await process.wait()
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+    return returncode
+
+
 async def provision_tart_vm(config: typing.Dict):
-    random = binascii.hexlify(os.urandom(4)).decode("ascii")
-    runner_name = f"{config['runner_base_name']}-{random}"
+    suffix = secrets.token_hex(4)
+    runner_name = f"{config['runner_base_name']}-{suffix}"
     log(f"Provisioning: {runner_name}")
-    result = await trio.run_process(
-        ["tart", "clone", config["base_image"], runner_name]
-    )
-    if result.returncode != 0:
+    try:
+        await run_command(["tart", "clone", config["base_image"], runner_name])
+    except subprocess.CalledProcessError:
         log("Failed to clone tart image")
-        sys.exit(1)
-    result = await trio.run_process(
-        [
-            "tart",
-            "set",
-            runner_name,
-            "--cpu",
-            str(config["cpus"]),
-            "--memory",
-            str(config["memory"]),
-        ]
-    )
-    if result.returncode != 0:
+        raise
+    if config["base_image_has_limits"]:
+        return runner_name
+    try:
+        await run_command(
+            [
+                "tart",
+                "set",
+                runner_name,
+                "--cpu",
+                str(config["cpus"]),
+                "--memory",
+                str(config["memory"]),
+            ]
+        )
+    except subprocess.CalledProcessError:
         log("Failed to set limits on tart image")
-        sys.exit(1)
+        await delete_tart_vm(runner_name)
+        raise
 
     return runner_name
 
 
+# Clones inherit the base image's settings, so if those already match the
+# config there is no need to spend a tart set invocation on every clone.
+async def base_image_has_limits(config: typing.Dict) -> bool:
+    result = await trio.run_process(
+        ["tart", "get", config["base_image"], "--format", "json"],
+        stdin=subprocess.DEVNULL,
+        capture_stdout=True,
+        stderr=subprocess.DEVNULL,
+        check=False,
+    )
+    if result.returncode != 0:
+        return False
+    settings = orjson.loads(result.stdout)
+    return (
+        settings.get("CPU") == config["cpus"]
+        and settings.get("Memory") == config["memory"]
+    )
+
+
 async def get_tart_ip(runner_name: str, retries: int) -> str:
-    attempts = 0
-    while attempts < retries:
-        try:
+    # Let tart do the waiting in a single process rather than polling it in
+    # short intervals. tart can fail immediately if the VM hasn't registered
+    # yet, so allow one more attempt before giving up.
+    wait = retries * 3
+    command = ["tart", "ip", runner_name, "--wait", str(wait)]
+    with trio.fail_after(wait * 2 + 5):
+        result = await trio.run_process(
+            command, capture_stdout=True, capture_stderr=True, check=False
+        )
+        if result.returncode != 0:
             result = await trio.run_process(
-                ["tart", "ip", runner_name, "--wait", "3"],
-                capture_stdout=True,
-                capture_stderr=True,
+                command, capture_stdout=True, capture_stderr=True
             )
-            break
-        except subprocess.CalledProcessError:
-            attempts += 1
-            continue
     return result.stdout.decode("ascii").strip()
 
 
+def check_actions_runner() -> None:
+    if not os.path.isfile(os.path.join(BASE_DIR, "actions-runner.tar.gz")):
+        log("Could not find actions-runner.tar.gz. Check the readme.")
+        sys.exit(1)
+
+
 async def startup_checks() -> None:
+    global _checked
+    if _checked:
+        return
     try:
         await trio.run_process(
-            ["tart", "--version"], capture_stdout=True, capture_stderr=True
+            ["tart", "--version"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
         )
     except FileNotFoundError:
         log(
@@ -138,30 +305,81 @@ async def startup_checks() -> None:
             f"shell frequently causes this. Your current PATH is: {os.environ['PATH']}"
         )
         sys.exit(1)
+    _checked = True
 
-    if not os.path.isfile(os.path.join(BASE_DIR, "actions-runner.tar.gz")):
-        log("Could not find actions-runner.tar.gz. Check the readme.")
-        sys.exit(1)
+
+# The SSH connection that copies files to a VM is kept open as a master so the
+# runner launch can reuse it and skip a second key exchange. The socket is named
+# after the VM rather than its address because the next VM is likely to be
+# handed the same IP.
+def ssh_control_path(runner_name: str) -> str:
+    return f"ControlPath=/tmp/cidermill-{runner_name}"
 
 
-async def scp_actions_runner(config: typing.Dict, ip: str) -> None:
+def prepare_shared_dir() -> None:
+    os.makedirs(SHARED_DIR, exist_ok=True)
+    for source in (
+        os.path.join(BASE_DIR, "actions-runner.tar.gz"),
+        os.path.join(BASE_DIR, "files", "runner-launcher.sh"),
+    ):
+        # Relink on every start so the share picks up a replaced tarball.
+        target = os.path.join(SHARED_DIR, os.path.basename(source))
+        if os.path.lexists(target):
+            os.remove(target)
+        os.link(source, target)
+
+
+async def scp_actions_runner(config: typing.Dict, runner_name: str, ip: str) -> None:
     log("Copying files to VM")
-    await trio.run_process(
-        [
-            "scp",
-            "-i",
-            "./id_rsa",
-            "-o",
-            "StrictHostKeyChecking=no",
-            "-o",
-            "UserKnownHostsFile=/dev/null",
-            os.path.join(BASE_DIR, "actions-runner.tar.gz"),
-            os.path.join(BASE_DIR, "files", "runner-launcher.sh"),
-            f"{config['user']}@{ip}:~/",
-        ],
-        capture_stdout=True,
-        capture_stderr=True,
-    )
+    # Stream one tar archive over a single ssh connection and unpack it in the
+    # VM's home directory as it arrives. The host is always macOS, whose bsdtar
+    # can splice the entries of actions-runner.tar.gz into the stream with
+    # "@archive", so the runner never has to be unpacked on either side first.
+    # bsdtar is called by its full path because GNU tar, which is often first
+    # on a Homebrew PATH, doesn't understand "@archive".
+    read_fd, write_fd = os.pipe()
+    async with trio.open_nursery() as nursery:
+        try:
+            await nursery.start(
+                partial(
+                    trio.run_process,
+                    [
+                        "/usr/bin/bsdtar",
+                        "-cf",
+                        "-",
+                        "-C",
+                        os.path.join(BASE_DIR, "files"),
+                        "runner-launcher.sh",
+                        "@" + os.path.join(BASE_DIR, "actions-runner.tar.gz"),
+                    ],
+                    stdin=subprocess.DEVNULL,
+                    stdout=write_fd,
+                )
+            )
+            await nursery.start(
+                partial(
+                    trio.run_process,
+                    [
+                        "ssh",
+                        *SSH_OPTS,
+                        *SSH_MASTER_OPTS,
+                        "-o",
+                        ssh_control_path(runner_name),
+                        f"{config['user']}@{ip}",
+                        "tar -xf -",
+                    ],
+                    stdin=read_fd,
+                    # The backgrounded master inherits these, so pipes would
+                    # not see EOF until it exits.
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            )
+        finally:
+            # Both children hold their own copies now; closing ours lets ssh
+            # see EOF once tar is done writing.
+            os.close(read_fd)
+            os.close(write_fd)
     log("Copied files to VM")
 
 
@@ -172,45 +390,70 @@ async def signal_handler():
 
 
 async def log_output(runner_process: trio.Process, runner_name: str):
-    decoder = codecs.getincrementaldecoder("utf8")()
     assert runner_process.stdout is not None
+    # Multiple runners may interleave their output so we prefix each line with
+    # the runner name. Splitting on b"\n" never cuts a UTF-8 sequence in half,
+    # so the bytes can be passed through without decoding them.
+    prefix = f"{runner_name}: ".encode()
+    pending = b""
     async for b in runner_process.stdout:
-        # Multiple runners may interleave their output so we
-        # prefix with runner name.
-        log(textwrap.indent(decoder.decode(b), f"{runner_name}: "))
-
-
-async def run_vm_then_cancel(runner_name: str, cancel_scope):
+        *lines, pending = (pending + b).split(b"\n")
+        if lines:
+            sys.stdout.buffer.write(b"".join(prefix + line + b"\n" for line in lines))
+            sys.stdout.buffer.flush()
+    if pending:
+        sys.stdout.buffer.write(prefix + pending + b"\n")
+        sys.stdout.buffer.flush()
+
+
+async def run_vm_then_cancel(config: typing.Dict, runner_name: str, cancel_scope):
+    command = ["tart", "run", runner_name, "--no-graphics"]
+    if config["share_runner_files"]:
+        command.append(f"--dir=cidermill:{SHARED_DIR}:ro")
     try:
-        await trio.run_process(
-            ["tart", "run", runner_name, "--no-graphics"], check=False
-        )
+        await trio.run_process(command, check=False)
     finally:
         cancel_scope.cancel()
 
 
+async def send_registration_token(
+    config: typing.Dict, send_channel: trio.MemorySendChannel
+) -> None:
+    async with send_channel:
+        await send_channel.send(await get_registration_token(config))
+
+
 async def run_runner_then_cancel(config: typing.Dict, runner_name: str, cancel_scope):
     try:
         async with trio.open_nursery() as nursery:
+            # The registration token doesn't depend on the VM, so fetch it while
+            # we wait for the VM to boot and copy the runner over.
+            send_token, receive_token = trio.open_memory_channel(1)
+            nursery.start_soon(send_registration_token, config, send_token)
             ip = await get_tart_ip(runner_name, 4)
-            await scp_actions_runner(config, ip)
-            token = await get_registration_token(config)
+            if config["share_runner_files"]:
+                launcher = SHARED_LAUNCHER
+            else:
+                await scp_actions_runner(config, runner_name, ip)
+                launcher = "~/runner-launcher.sh"
+            token = await receive_token.receive()
             log("Launching runner...")
             runner_process: trio.Process = await nursery.start(
                 partial(
                     trio.run_process,
                     [
                         "ssh",
-                        "-i",
-                        "./id_rsa",
-                        "-o",
-                        "StrictHostKeyChecking=no",
+                        *SSH_OPTS,
                         "-o",
-                        "UserKnownHostsFile=/dev/null",
+                        ssh_control_path(runner_name),
                         f"{config['user']}@{ip}",
-                        f"~/runner-launcher.sh {token} "
-                        f"{runner_name} https://github.com/{config['org']} "
-                        f"{config['labels']}",
+                        LAUNCH_COMMAND.format(
+                            launcher=launcher,
+                            token=token,
+                            runner_name=runner_name,
+                            org=config["org"],
+                            labels=config["labels"],
+                        ),
                     ],
                     check=False,
                     stdout=subprocess.PIPE,
@@ -222,48 +465,162 @@ async def run_runner_then_cancel(config: typing.Dict, runner_name: str, cancel_s
         cancel_scope.cancel()
 
 
+async def delete_tart_vm(runner_name: str) -> None:
+    # shield=True means that the code inside is protected from outside cancellation,
+    #  so the run_command call still gets a chance to run even if this whole
+    # function is cancelled. So we put a timeout on it, to make sure that it
+    # can't hang the whole program.
+    with trio.CancelScope(deadline=trio.current_time() + 5, shield=True):
+        await run_command(["tart", "delete", runner_name])
+
+
+async def sleep_before_retry(retries: int) -> None:
+    # Cap the backoff and add jitter so that tasks failing together (e.g. during
+    # a GitHub outage) don't all retry in lockstep.
+    delay = min(MAX_RETRY_DELAY, 2**retries) * (0.5 + random.random())
+    log(f"Sleeping {delay:.1f} seconds before retrying")
+    await trio.sleep(delay)
+
+
+# This keeps freshly cloned VMs waiting in send_channel so that runners don't have
+# to wait on tart clone between jobs. The clones are not booted ahead of time:
+# Apple only allows two macOS VMs to run at once, and a booted spare would take
+# one of those slots away from a runner.
+async def keep_vm_pool_filled(config, send_channel: trio.MemorySendChannel):
+    async with send_channel:
+        retries = 0
+        while True:
+            try:
+                runner_name = await provision_tart_vm(config)
+                retries = 0
+            except Exception as e:
+                log("Failed to provision VM, retrying.")
+                log(e)
+                retries += 1
+                await sleep_before_retry(retries)
+                continue
+            try:
+                await send_channel.send(runner_name)
+            except BaseException:
+                await delete_tart_vm(runner_name)
+                raise
+
+
 # This runs a single VM from start to finish, including cleanup.
-async def runner(config):
-    runner_name = await provision_tart_vm(config)
+async def runner(config, runner_name: str):
     try:
         # This starts up both processes, and makes sure that as soon as one of them
         # exits the other also exits. And once both processes are dead, the nursery
         # block exits.
         async with trio.open_nursery() as nursery:
-            nursery.start_soon(run_vm_then_cancel, runner_name, nursery.cancel_scope)
+            nursery.start_soon(
+                run_vm_then_cancel, config, runner_name, nursery.cancel_scope
+            )
             nursery.start_soon(
                 run_runner_then_cancel, config, runner_name, nursery.cancel_scope
             )
     finally:
-        # shield=True means that the code inside is protected from outside cancellation,
-        #  so the run_process call still gets a chance to run even if this whole
-        # function is cancelled. So we put a timeout on it, to make sure that it
-        # can't hang the whole program.
-        with trio.CancelScope(deadline=trio.current_time() + 5, shield=True):
-            await trio.run_process(["tart", "delete", runner_name])
+        await delete_tart_vm(runner_name)
 
 
 async def main(config: typing.Dict):
     await startup_checks()
+    config["base_image_has_limits"] = await base_image_has_limits(config)
+
+    # The pool task holds one clone while it blocks on send, so the channel
+    # only needs to buffer the rest.
+    send_vm, receive_vm = trio.open_memory_channel(max(config["pool_size"] - 1, 0))
 
     async def keep_one_runner_running():
         retries = 0
         while True:
             try:
-                await runner(config)
+                runner_name = await receive_vm.receive()
+                await runner(config, runner_name)
                 retries = 0
             except Exception as e:
                 log("Exception propagated to top level, restarting runner.")
                 log(e)
                 retries += 1
-                log(f"Sleeping {2 ** retries} seconds before retrying")
-                await trio.sleep(2 ** retries)
+                await sleep_before_retry(retries)
                 continue
 
-    async with trio.open_nursery() as nursery:
-        nursery.start_soon(signal_handler)
-        for _ in range(config["num_vms"]):
-            nursery.start_soon(keep_one_runner_running)
+    # A single client is shared by every runner so that the connection to
+    # api.github.com is kept alive between VM cycles, and requests from
+    # different runners are multiplexed over it with HTTP/2.
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=5,
+        limits=httpx.Limits(max_keepalive_connections=4),
+    )
+    async with httpx.AsyncClient(transport=transport) as client:
+        config["http_client"] = client
+        try:
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(signal_handler)
+                nursery.start_soon(keep_vm_pool_filled, config, send_vm)
+                for _ in range(config["num_vms"]):
+                    nursery.start_soon(keep_one_runner_running)
+        finally:
+            # Clones still waiting in the pool were never handed to a runner.
+            while True:
+                try:
+                    runner_name = receive_vm.receive_nowait()
+                except (trio.WouldBlock, trio.EndOfChannel):
+                    break
+                await delete_tart_vm(runner_name)
+
+
+def run_worker(num_vms: int) -> None:
+    # Workers load their own config rather than receiving it from the parent, as
+    # the signing key can't be pickled across processes.
+    config = load_config()
+    config["num_vms"] = num_vms
+    trio.run(main, config)
+
+
+# Splits num_vms across worker processes so JWT signing, TLS and JSON parsing
+# for different runners aren't all competing for a single GIL.
+def run_workers(config: typing.Dict) -> None:
+    workers = config["workers"]
+    shards = [
+        config["num_vms"] // workers + (i < config["num_vms"] % workers)
+        for i in range(workers)
+    ]
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(num_vms,))
+        for num_vms in shards
+        if num_vms > 0
+    ]
+    for process in processes:
+        process.start()
+
+    # Each worker cleans up its own VMs on SIGINT or SIGTERM. Ctrl-C already
+    # reaches them through the process group, so only SIGTERM (e.g. from
+    # launchd) needs passing along.
+    def forward_sigterm(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, forward_sigterm)
+    for process in processes:
+        process.join()
+    if any(process.exitcode != 0 for process in processes):
+        sys.exit(1)
 
 
-trio.run(main, load_config())
+if __name__ == "__main__":
+    # Fail before starting trio (or any workers) if the runner is missing.
+    check_actions_runner()
+    config = load_config()
+    # Done here rather than in main so that workers don't race to relink the
+    # same files.
+    if config["share_runner_files"]:
+        prepare_shared_dir()
+    if config["workers"] > 1:
+        run_workers(config)
+    else:
+        trio.run(main, config)